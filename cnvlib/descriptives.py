@@ -124,15 +124,23 @@ def modal_location(a):
 
 @on_weighted_array()
 def weighted_median(a, weights):
-    """Weighted median of a 1-D numeric array."""
-    order = a.argsort()
+    """Weighted median of a 1-D numeric array.
+
+    Equal values are pooled with their combined weight, so the result does not
+    depend on the order of ties.
+    """
+    order = a.argsort(kind='mergesort')
     a = a[order]
-    weights = weights[order]
-    midpoint = 0.5 * weights.sum()
+    cumulative_weight = weights[order].cumsum()
+    # Pool equal values, keeping the last of each run
+    is_last = np.append(a[1:] != a[:-1], True)
+    a = a[is_last]
+    cumulative_weight = cumulative_weight[is_last]
+    weights = np.diff(cumulative_weight, prepend=0)
+    midpoint = 0.5 * cumulative_weight[-1]
     if (weights > midpoint).any():
         # Any point with the majority of total weight must be the median
         return a[weights.argmax()]
-    cumulative_weight = weights.cumsum()
     midpoint_idx = cumulative_weight.searchsorted(midpoint)
     if (midpoint_idx > 0 and
         cumulative_weight[midpoint_idx-1] - midpoint < sys.float_info.epsilon):
@@ -141,6 +149,82 @@ def weighted_median(a, weights):
     return a[midpoint_idx]
 
 
+def grouped_weighted_median(group_ids, values, weights, n_groups,
+                            max_stepped_size=1000):
+    """Weighted median of `values` within each group, vectorized across groups.
+
+    Equivalent to calling `weighted_median` on each group's values and weights,
+    where `group_ids` are integer codes 0..`n_groups`-1 assigning each element
+    to a group. Groups with no non-NaN values get NaN. Groups larger than
+    `max_stepped_size` are passed to `weighted_median` one at a time.
+    """
+    group_ids = np.asarray(group_ids)
+    values = np.asfarray(values)
+    weights = np.asfarray(weights)
+    # Drop NaN values from all arrays, and fill NaN weights with 0
+    ok = ~np.isnan(values)
+    group_ids = group_ids[ok]
+    values = values[ok]
+    weights = np.nan_to_num(weights[ok])
+    # Sort by value within each group; groups become contiguous
+    order = np.lexsort((values, group_ids))
+    group_ids = group_ids[order]
+    values = values[order]
+    weights = weights[order]
+    codes = np.arange(n_groups)
+    starts = group_ids.searchsorted(codes, 'left')
+    ends = group_ids.searchsorted(codes, 'right')
+    result = np.full(n_groups, np.nan)
+    filled = ends > starts
+    if not filled.any():
+        return result
+    starts = starts[filled]
+    ends = ends[filled]
+    sizes = ends - starts
+    is_large = sizes > max_stepped_size
+    # Cumulative weight within each group, summed sequentially as in
+    # weighted_median. Step through the positions within the smaller groups,
+    # longest first, so the number of steps is bounded by max_stepped_size.
+    small_sizes = sizes[~is_large]
+    desc_starts = starts[~is_large][np.argsort(-small_sizes, kind='mergesort')]
+    offsets = np.arange(1, small_sizes.max()) if len(small_sizes) else []
+    n_longer = (len(small_sizes)
+                - np.sort(small_sizes).searchsorted(offsets, 'right'))
+    cumulative_weight = weights.copy()
+    for offset, n_groups_left in zip(offsets, n_longer):
+        idx = desc_starts[:n_groups_left] + offset
+        cumulative_weight[idx] += cumulative_weight[idx - 1]
+    midpoints = 0.5 * cumulative_weight[ends - 1]
+    # Pool equal values within each group, keeping the last of each run
+    is_last = np.ones(len(values), dtype=bool)
+    is_last[:-1] = (values[1:] != values[:-1])
+    is_last[ends - 1] = True
+    run_idx = np.flatnonzero(is_last)
+    run_values = values[run_idx]
+    run_cumulative = cumulative_weight[run_idx]
+    run_groups = np.repeat(np.arange(len(starts)), sizes)[run_idx]
+    run_starts = run_groups.searchsorted(np.arange(len(starts)))
+    n_runs = np.diff(np.append(run_starts, len(run_idx)))
+    run_weights = np.diff(run_cumulative, prepend=0)
+    run_weights[run_starts] = run_cumulative[run_starts]
+    # Number of runs before each group's cumulative weight reaches its
+    # midpoint, i.e. searchsorted within the group
+    n_below = np.add.reduceat(
+        (run_cumulative < midpoints[run_groups]).astype(int), run_starts)
+    midpoint_idx = run_starts + np.minimum(n_below, n_runs - 1)
+    medians = np.where(n_below == 0, run_values[midpoint_idx],
+                       0.5 * (run_values[midpoint_idx - 1]
+                              + run_values[midpoint_idx]))
+    # Any point with the majority of total weight must be the median
+    major_idx = np.flatnonzero(run_weights > midpoints[run_groups])
+    medians[run_groups[major_idx]] = run_values[major_idx]
+    for i in np.flatnonzero(is_large):
+        medians[i] = weighted_median(values[starts[i]:ends[i]],
+                                     weights[starts[i]:ends[i]])
+    result[filled] = medians
+    return result
+
+
 # Estimators of scale
 
 @on_array(0)
@@ -1,12 +1,12 @@
 """Filter copy number segments."""
 import functools
 import logging
+import warnings
 
 import numpy as np
 import pandas as pd
-import hashlib
 
-from .descriptives import weighted_median
+from .descriptives import grouped_weighted_median, weighted_median
 
 
 def require_column(*colnames):
@@ -20,12 +20,16 @@ def require_column(*colnames):
     else:
         msg = "'{}' filter requires columns " + \
                 ", ".join(["'{}'"] * len(colnames))
+    msg += "; missing: {}"
     def wrap(func):
         @functools.wraps(func)
         def wrapped_f(segarr):
             filtname = func.__name__
-            if any(c not in segarr for c in colnames):
-                raise ValueError(msg.format(filtname, *colnames))
+            present = set(segarr.data.columns)
+            missing = [c for c in colnames if c not in present]
+            if missing:
+                raise ValueError(msg.format(filtname, *colnames,
+                                            ", ".join(map(repr, missing))))
             result = func(segarr)
             logging.info("Filtered by '%s' from %d to %d rows",
                          filtname, len(segarr), len(result))
@@ -35,89 +39,176 @@ def require_column(*colnames):
 
 
 def squash_by_groups(cnarr, levels, by_arm=False):
-    """Reduce CopyNumArray rows to a single row within each given level."""
+    """Reduce CopyNumArray rows to a single row within each given level.
+
+    `levels` is an array or Series of the same length as `cnarr`, matched to
+    its rows by position.
+    """
     # Enumerate runs of identical values
     change_levels = enumerate_changes(levels)
-    assert (change_levels.index == levels.index).all()
-    assert cnarr.data.index.is_unique
-    assert levels.index.is_unique
-    assert change_levels.index.is_unique
+    assert len(change_levels) == len(cnarr)
     if by_arm:
         # Enumerate chromosome arms
-        arm_levels = []
-        for i, (_chrom, cnarm) in enumerate(cnarr.by_arm()):
-            arm_levels.append(np.repeat(i, len(cnarm)))
-        change_levels += np.concatenate(arm_levels)
+        arm_levels = (cnarr.arm_starts()
+                      .searchsorted(np.arange(len(cnarr)), 'right') - 1)
+        change_levels += arm_levels
     else:
         # Enumerate chromosomes
-        chrom_names = cnarr['chromosome'].unique()
-        chrom_col = (cnarr['chromosome']
-                     .replace(chrom_names, np.arange(len(chrom_names))))
+        chrom_col = pd.factorize(cnarr['chromosome'].to_numpy(), sort=False)[0]
         change_levels += chrom_col
-    data = cnarr.data.assign(_group=change_levels)
-    groupkey = ['_group']
+    data = cnarr.data
+    keys = pd.DataFrame({'_group': change_levels})
     if 'cn1' in cnarr:
         # Keep allele-specific CNAs separate
-        data['_g1'] = enumerate_changes(cnarr['cn1'])
-        data['_g2'] = enumerate_changes(cnarr['cn2'])
-        groupkey.extend(['_g1', '_g2'])
-    data = (data.groupby(groupkey, as_index=False, group_keys=False, sort=False)
-            .apply(squash_region)
-            .reset_index(drop=True))
-    return cnarr.as_dataframe(data)
+        keys['_g1'] = enumerate_changes(cnarr['cn1'])
+        keys['_g2'] = enumerate_changes(cnarr['cn2'])
+    group_ids = keys.groupby(list(keys.columns), sort=False).ngroup().to_numpy()
+    n_groups = group_ids.max() + 1 if len(group_ids) else 0
+    if n_groups == len(data):
+        # Every group is a single row, so there is nothing to merge
+        return _squash_singletons(cnarr)
+    # Sort rows by group once; then each group is a slice [start, end)
+    order = np.argsort(group_ids, kind='mergesort')
+    group_ids = group_ids[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(group_ids)) + 1))
+    ends = np.concatenate((starts[1:], [len(group_ids)]))
+
+    def column(name):
+        return data[name].to_numpy()[order]
+
+    weights = column('weight')
+    region_weight = np.add.reduceat(np.nan_to_num(weights), starts)
+    unweighted = np.flatnonzero(region_weight <= 0)
+    # Weighted means of all averaged columns, computed together in one pass
+    avg_cols = [c for c in ('log2', 'depth', 'baf') if c in data]
+    avg_values = data[avg_cols].to_numpy(dtype=float)[order]
+    # NaN values propagate to the group's mean, as with np.average
+    products = avg_values * weights[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = (np.add.reduceat(products, starts)
+                    / region_weight[:, np.newaxis])
+    with warnings.catch_warnings():
+        # All-NaN columns give NaN, with a warning we don't need
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i in unweighted:
+            # Unweighted groups get a simple mean instead, skipping NaN
+            averages[i] = np.nanmean(avg_values[starts[i]:ends[i]], axis=0)
+    averages = dict(zip(avg_cols, averages.T))
+
+    def median(col):
+        values = column(col)
+        medians = grouped_weighted_median(group_ids, values, weights, n_groups)
+        for i in unweighted:
+            medians[i] = np.median(values[starts[i]:ends[i]])
+        return medians
+
+    out = pd.DataFrame({'chromosome': column('chromosome')[starts],
+                        'start': column('start')[starts],
+                        'end': column('end')[ends - 1],
+                       },
+                       columns=['chromosome', 'start', 'end'])
+    out['log2'] = averages['log2']
+    genes = column('gene').tolist()
+    out['gene'] = [','.join(dict.fromkeys(genes[start:end]))
+                   for start, end in zip(starts, ends)]
+    out['probes'] = (np.add.reduceat(column('probes'), starts)
+                     if 'probes' in data else ends - starts)
+    out['weight'] = region_weight
+    if 'depth' in data:
+        out['depth'] = averages['depth']
+    if 'baf' in data:
+        out['baf'] = averages['baf']
+    if 'cn' in data:
+        out['cn'] = median('cn')
+        if 'cn1' in data:
+            out['cn1'] = median('cn1')
+            out['cn2'] = out['cn'] - out['cn1']
+    if 'p_bintest' in data:
+        out['p_bintest'] = np.fmax.reduceat(column('p_bintest'), starts)
+    return cnarr.as_dataframe(out)
+
+
+def _squash_singletons(cnarr):
+    """Reduce each row to the same fields as squash_by_groups, unmerged."""
+    data = cnarr.data
+    out = data.loc[:, ['chromosome', 'start', 'end', 'log2', 'gene']]
+    out['probes'] = data['probes'] if 'probes' in data else 1
+    # Missing weights sum to 0, as when merging
+    out['weight'] = data['weight'].fillna(0)
+    if 'depth' in data:
+        out['depth'] = data['depth']
+    if 'baf' in data:
+        out['baf'] = data['baf']
+    if 'cn' in data:
+        out['cn'] = data['cn']
+        if 'cn1' in data:
+            out['cn1'] = data['cn1']
+            out['cn2'] = data['cn'] - data['cn1']
+    if 'p_bintest' in data:
+        out['p_bintest'] = data['p_bintest']
+    return cnarr.as_dataframe(out.reset_index(drop=True))
 
 
 def enumerate_changes(levels):
     """Assign a unique integer to each run of identical values.
 
     Repeated but non-consecutive values will be assigned different integers.
+    Consecutive missing (NaN) values are treated as one run.
+    Accepts an array or Series; returns an integer array.
     """
-    return levels.diff().fillna(0).abs().cumsum().astype(int)
+    values = np.asarray(levels)
+    changed = values[1:] != values[:-1]
+    if values.dtype.kind == 'f':
+        changed &= ~(np.isnan(values[1:]) & np.isnan(values[:-1]))
+    run_ids = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(changed, out=run_ids[1:])
+    return run_ids
 
 
 def squash_region(cnarr):
     """Reduce a CopyNumArray to 1 row, keeping fields sensible.
 
-    Most fields added by the `segmetrics` command will be dropped.
+    Most fields added by the `segmetrics` command will be dropped. The row is
+    returned as a pandas Series, for use with `groupby(...).apply`.
     """
     assert 'weight' in cnarr
-    out = {'chromosome': [cnarr['chromosome'].iat[0]],
+    out = {'chromosome': cnarr['chromosome'].iat[0],
            'start': cnarr['start'].iat[0],
            'end': cnarr['end'].iat[-1],
           }
-    region_weight = cnarr['weight'].sum()
-    if region_weight > 0:
-        out['log2'] = np.average(cnarr['log2'], weights=cnarr['weight'])
-    else:
-        out['log2'] = np.mean(cnarr['log2'])
-    out['gene'] = ','.join(cnarr['gene'].drop_duplicates())
+    weights = cnarr['weight'].to_numpy()
+    region_weight = np.nansum(weights)
+
+    def average(col):
+        values = cnarr[col].to_numpy()
+        if region_weight > 0:
+            return float(values @ weights) / region_weight
+        # Series.mean skips NaN
+        return cnarr[col].mean()
+
+    out['log2'] = average('log2')
+    out['gene'] = ','.join(dict.fromkeys(cnarr['gene'].to_numpy().tolist()))
     out['probes'] = cnarr['probes'].sum() if 'probes' in cnarr else len(cnarr)
     out['weight'] = region_weight
     if 'depth' in cnarr:
-        if region_weight > 0:
-            out['depth'] = np.average(cnarr['depth'], weights=cnarr['weight'])
-        else:
-            out['depth'] = np.mean(cnarr['depth'])
+        out['depth'] = average('depth')
     if 'baf' in cnarr:
-        if region_weight > 0:
-            out['baf'] = np.average(cnarr['baf'], weights=cnarr['weight'])
-        else:
-            out['baf'] = np.mean(cnarr['baf'])
+        out['baf'] = average('baf')
     if 'cn' in cnarr:
         if region_weight > 0:
-            out['cn'] = weighted_median(cnarr['cn'], cnarr['weight'])
+            out['cn'] = weighted_median(cnarr['cn'], weights)
         else:
             out['cn'] = np.median(cnarr['cn'])
         if 'cn1' in cnarr:
             if region_weight > 0:
-                out['cn1'] = weighted_median(cnarr['cn1'], cnarr['weight'])
+                out['cn1'] = weighted_median(cnarr['cn1'], weights)
             else:
                 out['cn1'] = np.median(cnarr['cn1'])
             out['cn2'] = out['cn'] - out['cn1']
     if 'p_bintest' in cnarr:
         # Only relevant for single-bin segments, but this seems safe/conservative
         out['p_bintest'] = cnarr['p_bintest'].max()
-    return pd.DataFrame(out)
+    return pd.Series(out)
 
 
 @require_column('cn')
@@ -134,12 +225,14 @@ def ampdel(segarr):
     actionable, usually focal, CNAs. Any real and potentially informative but
     lower-level CNAs will be dropped.
     """
-    levels = np.zeros(len(segarr))
-    levels[segarr['cn'] == 0] = -1
-    levels[segarr['cn'] >= 5] = 1
+    cn = segarr['cn'].to_numpy()
+    levels = (cn >= 5).astype(np.int8) - (cn == 0).astype(np.int8)
     # or: segarr['log2'] >= np.log2(2.5)
-    cnarr = squash_by_groups(segarr, pd.Series(levels))
-    return cnarr[(cnarr['cn'] == 0) | (cnarr['cn'] >= 5)]
+    # Neutral runs would be dropped after merging, so skip them entirely.
+    # Number the runs first to keep CNAs separated by neutral segments apart.
+    is_reported = (levels != 0)
+    run_ids = enumerate_changes(levels)
+    return squash_by_groups(segarr[is_reported], run_ids[is_reported])
 
 
 @require_column('depth')
@@ -158,14 +251,14 @@ def ci(segarr):
     Segments with lower CI above 0 are kept as gains, upper CI below 0 as
     losses, and the rest with CI overlapping zero are collapsed as neutral.
     """
-    levels = np.zeros(len(segarr))
     # if len(segarr) < 10:
     #     logging.warning("* segarr :=\n%s", segarr)
     #     logging.warning("* segarr['ci_lo'] :=\n%s", segarr['ci_lo'])
     #     logging.warning("* segarr['ci_lo']>0 :=\n%s", segarr['ci_lo'] > 0)
-    levels[segarr['ci_lo'].values > 0] = 1
-    levels[segarr['ci_hi'].values < 0] = -1
-    return squash_by_groups(segarr, pd.Series(levels))
+    ci_lo = segarr['ci_lo'].to_numpy()
+    ci_hi = segarr['ci_hi'].to_numpy()
+    levels = (ci_lo > 0).astype(np.int8) - (ci_hi < 0).astype(np.int8)
+    return squash_by_groups(segarr, levels)
 
 
 @require_column('ci_lo', 'ci_hi', 'baf')
@@ -182,10 +275,17 @@ def ci_baf(segarr):
     min_baf_amp = calculate_min_baf_amp(0.2)
     min_baf_del = calculate_min_baf_del(0.2)
 
-    levels = np.zeros(len(segarr))
-    levels[(segarr['ci_lo'].values > 0) & (segarr['baf']> min_baf_amp)] = 1
-    levels[(segarr['ci_hi'].values < 0) & (segarr['baf']> min_baf_del)] = -1 # 0.6 is the obs baf of 1+0 in purity=0.2. If lower value is choosen, it will allow lower purity at the cost of merging real cnv event with 1+1.
-    return squash_by_groups(segarr, pd.Series(levels))
+    ci_lo = segarr['ci_lo'].to_numpy()
+    ci_hi = segarr['ci_hi'].to_numpy()
+    baf = segarr['baf'].to_numpy()
+    gain_mask = ci_lo > 0
+    gain_mask &= baf > min_baf_amp
+    # 0.6 is the obs baf of 1+0 in purity=0.2. If lower value is choosen, it
+    # will allow lower purity at the cost of merging real cnv event with 1+1.
+    loss_mask = ci_hi < 0
+    loss_mask &= baf > min_baf_del
+    levels = gain_mask.astype(np.int8) - loss_mask.astype(np.int8)
+    return squash_by_groups(segarr, levels)
 
 @require_column('log2')
 def log2(segarr):
@@ -196,10 +296,12 @@ def log2(segarr):
     min_baf_amp = calculate_min_baf_amp(0.2)
     min_baf_del = calculate_min_baf_del(0.2)
 
-    levels = np.zeros(len(segarr))
-    levels[(segarr['log2']>-0.15) & (segarr['baf']<min_baf_del)] = 0
-    levels[(segarr['log2']<0.14) & (segarr['baf']<min_baf_amp)] = 0
-    return squash_by_groups(segarr, pd.Series(levels))
+    log2_value = segarr['log2'].to_numpy()
+    baf = segarr['baf'].to_numpy()
+    levels = np.zeros(len(segarr), dtype=np.int8)
+    levels[(log2_value > -0.15) & (baf < min_baf_del)] = 0
+    levels[(log2_value < 0.14) & (baf < min_baf_amp)] = 0
+    return squash_by_groups(segarr, levels)
 
 @require_column('pi_lo', 'pi_hi')
 def pi(segarr):
@@ -208,10 +310,10 @@ def pi(segarr):
     Segments with lower PI above 0 are kept as gains, upper PI below 0 as
     losses, and the rest with PI overlapping zero are collapsed as neutral.
     """
-    levels = np.zeros(len(segarr))
-    levels[segarr['pi_lo'].values > 0] = 1
-    levels[segarr['pi_hi'].values < 0] = -1
-    return squash_by_groups(segarr, pd.Series(levels))
+    pi_lo = segarr['pi_lo'].to_numpy()
+    pi_hi = segarr['pi_hi'].to_numpy()
+    levels = (pi_lo > 0).astype(np.int8) - (pi_hi < 0).astype(np.int8)
+    return squash_by_groups(segarr, levels)
 
 
 @require_column('cn')
@@ -221,14 +323,18 @@ def cn(segarr):
 
 @require_column('cn1', 'cn2', 'aberrant_cell_frac')
 def cn_subclone(segarr):
-    """Merge segments by integer copy number."""
-    df = segarr.data
-    for index, row in df.iterrows():
-        df.loc[index, 'hash'] = hashlib.md5(str(row[['cn1','cn2','aberrant_cell_frac']].values).encode('utf-8')).hexdigest()
-    hash_key = list(df['hash'].unique())
-    df['level'] = df['hash'].apply(lambda x: hash_key.index(x))
+    """Merge segments by allele-specific copy number and subclone fraction.
 
-    return squash_by_groups(segarr, df['level'])
+    The input array is not modified; no helper columns are added to it.
+    """
+    keys = pd.MultiIndex.from_arrays([segarr['cn1'].values,
+                                      segarr['cn2'].values,
+                                      segarr['aberrant_cell_frac'].values])
+    # Combine the integer codes of each key column into one code per row.
+    # Missing values are code -1 in every row, so they compare equal here.
+    levels = np.ravel_multi_index([codes + 1 for codes in keys.codes],
+                                  [len(lvl) + 1 for lvl in keys.levels])
+    return squash_by_groups(segarr, levels)
 
 @require_column('sem')
 def sem(segarr, zscore=1.96):
@@ -238,8 +344,9 @@ def sem(segarr, zscore=1.96):
     `zscore`). Segments with lower CI above 0 are kept as gains, upper CI below
     0 as losses, and the rest with CI overlapping zero are collapsed as neutral.
     """
-    margin = segarr['sem'] * zscore
-    levels = np.zeros(len(segarr))
-    levels[segarr['log2'] - margin > 0] = 1
-    levels[segarr['log2'] + margin < 0] = -1
-    return squash_by_groups(segarr, pd.Series(levels))
+    log2_value = segarr['log2'].to_numpy()
+    margin = segarr['sem'].to_numpy() * zscore
+    # i.e. log2 - margin > 0, log2 + margin < 0
+    levels = ((log2_value > margin).astype(np.int8)
+              - (log2_value < -margin).astype(np.int8))
+    return squash_by_groups(segarr, levels)
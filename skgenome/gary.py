@@ -231,33 +231,43 @@ class GenomicArray(object):
         # - Cache centromere locations once found
         self.data.chromosome = self.data.chromosome.astype(str)
         for chrom, subtable in self.data.groupby("chromosome", sort=False):
-            margin = max(min_arm_bins, int(round(.1 * len(subtable))))
-            if len(subtable) > 2 * margin + 1:
-                # Found a candidate centromere
-                gaps = (subtable.start.values[margin+1:-margin] -
-                        subtable.end.values[margin:-margin-1])
-                cmere_idx = gaps.argmax() + margin + 1
-                cmere_size = gaps[cmere_idx - margin - 1]
-            else:
-                cmere_idx = 0
-                cmere_size = 0
-            if cmere_idx and cmere_size >= min_gap_size:
-                logging.debug("%s centromere at %d of %d bins (size %s)",
-                             chrom, cmere_idx, len(subtable), cmere_size)
+            cmere_idx = _find_centromere(chrom, subtable.start.values,
+                                         subtable.end.values,
+                                         min_gap_size, min_arm_bins)
+            if cmere_idx:
                 p_arm = subtable.index[:cmere_idx]
                 yield chrom, self.as_dataframe(subtable.loc[p_arm,:])
                 q_arm = subtable.index[cmere_idx:]
                 yield chrom, self.as_dataframe(subtable.loc[q_arm,:])
             else:
                 # No centromere found -- emit the whole chromosome
-                if cmere_idx:
-                    logging.debug("%s: Ignoring centromere at %d of %d bins (size %s)",
-                                  chrom, cmere_idx, len(subtable), cmere_size)
-                else:
-                    logging.debug("%s: Skipping centromere search, too small",
-                                  chrom)
                 yield chrom, self.as_dataframe(subtable)
 
+    def arm_starts(self, min_gap_size=1e5, min_arm_bins=50):
+        """Row offsets where each chromosome arm (inferred) begins.
+
+        Arms are split the same way as in `by_arm`, assuming each chromosome's
+        bins are contiguous in this array.
+        """
+        if not len(self):
+            return np.array([], dtype=int)
+        chroms = self.data.chromosome.values
+        starts = self.data.start.values
+        ends = self.data.end.values
+        chrom_starts = np.concatenate((
+            [0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1))
+        chrom_ends = np.concatenate((chrom_starts[1:], [len(chroms)]))
+        arm_starts = []
+        for c_start, c_end in zip(chrom_starts, chrom_ends):
+            arm_starts.append(c_start)
+            cmere_idx = _find_centromere(chroms[c_start],
+                                         starts[c_start:c_end],
+                                         ends[c_start:c_end],
+                                         min_gap_size, min_arm_bins)
+            if cmere_idx:
+                arm_starts.append(c_start + cmere_idx)
+        return np.array(arm_starts, dtype=int)
+
     def by_chromosome(self):
         """Iterate over bins grouped by chromosome name."""
         for chrom, subtable in self.data.groupby("chromosome", sort=False):
@@ -709,3 +719,30 @@ class GenomicArray(object):
                     genes[gene] = []
                 genes[gene].append(idx)
         return genes
+
+
+def _find_centromere(chrom, starts, ends, min_gap_size, min_arm_bins):
+    """Index of the bin following a chromosome's centromere, or 0 if none.
+
+    The centromere is inferred as the largest gap between consecutive bins,
+    away from the chromosome ends.
+    """
+    margin = max(min_arm_bins, int(round(.1 * len(starts))))
+    if len(starts) > 2 * margin + 1:
+        # Found a candidate centromere
+        gaps = starts[margin+1:-margin] - ends[margin:-margin-1]
+        cmere_idx = gaps.argmax() + margin + 1
+        cmere_size = gaps[cmere_idx - margin - 1]
+    else:
+        cmere_idx = 0
+        cmere_size = 0
+    if cmere_idx and cmere_size >= min_gap_size:
+        logging.debug("%s centromere at %d of %d bins (size %s)",
+                     chrom, cmere_idx, len(starts), cmere_size)
+        return cmere_idx
+    if cmere_idx:
+        logging.debug("%s: Ignoring centromere at %d of %d bins (size %s)",
+                      chrom, cmere_idx, len(starts), cmere_size)
+    else:
+        logging.debug("%s: Skipping centromere search, too small", chrom)
+    return 0
@@ -14,7 +14,8 @@ import numpy as np
 from skgenome import GenomicArray, tabio
 
 import cnvlib
-from cnvlib import (cnary, core, fix, smoothing, vary)
+from cnvlib import (cnary, core, descriptives, fix, segfilters, smoothing,
+                    vary)
 
 
 class CNATests(unittest.TestCase):
@@ -134,6 +135,160 @@ class OtherTests(unittest.TestCase):
         self.assertAlmostEqual(fix.edge_losses(target_size, insert_size),
                         2 * fix.edge_gains(target_size, gap_size, insert_size))
 
+    def test_grouped_weighted_median(self):
+        """Grouped weighted median matches the per-group calculation."""
+        values = np.array([3, 1, 2, 5, np.nan, 4, 4, 0, 7, 1.5, 6, 5])
+        weights = np.array([1, 1, 1, .2, 1, 5, .5, 2, 2, np.nan,
+                            .2, .2])
+        group_ids = np.array([0, 0, 0, 1, 1, 1, 2, 3, 3, 3, 5, 5])
+        result = descriptives.grouped_weighted_median(group_ids, values,
+                                                      weights, 6)
+        for i in (0, 1, 2, 3, 5):
+            in_group = (group_ids == i)
+            self.assertAlmostEqual(
+                result[i],
+                descriptives.weighted_median(values[in_group],
+                                             weights[in_group]))
+        self.assertTrue(np.isnan(result[4]))
+        # Tied values are pooled, so their order doesn't matter
+        values = np.array([3, 3, 0, 0, 2, 2, 1, 4, 1, 4, 1, 4])
+        weights = np.array([0, .7, 1, .3, 1, .1, .3, .2, .3, .2, .3, .2])
+        group_ids = np.repeat([0, 1], 6)
+        for order in (np.arange(12), np.array([3, 2, 1, 0, 5, 4,
+                                               11, 10, 9, 8, 7, 6])):
+            result = descriptives.grouped_weighted_median(
+                group_ids[order], values[order], weights[order], 2)
+            self.assertEqual(list(result), [1.0, 1.0])
+            for i in (0, 1):
+                in_group = order[group_ids[order] == i]
+                self.assertEqual(
+                    descriptives.weighted_median(values[in_group],
+                                                 weights[in_group]),
+                    result[i])
+        # Large groups give the same result as when stepped through
+        self.assertEqual(
+            list(descriptives.grouped_weighted_median(
+                group_ids, values, weights, 2, max_stepped_size=3)),
+            [1.0, 1.0])
+        # Ties and near-ties after many heavily weighted groups
+        n_filler = 100000
+        values = np.concatenate([np.ones(n_filler), [1, 2, 5, 6]])
+        weights = np.concatenate([np.repeat(100.0, n_filler),
+                                  [.5, .5001, .2, .2]])
+        group_ids = np.concatenate([np.arange(n_filler),
+                                    np.repeat([n_filler, n_filler + 1], 2)])
+        result = descriptives.grouped_weighted_median(group_ids, values,
+                                                      weights, n_filler + 2)
+        self.assertEqual(result[-2], 2.0)
+        self.assertEqual(result[-1],
+                         descriptives.weighted_median(values[-2:],
+                                                      weights[-2:]))
+
+    def test_squash_nan_baf(self):
+        """Merging segments keeps missing BAF values missing."""
+        cnarr = cnary.CopyNumArray.from_columns({
+            'chromosome': ['chr1'] * 7,
+            'start': np.arange(7) * 100,
+            'end': np.arange(7) * 100 + 100,
+            'gene': ['-'] * 7,
+            'log2': [0.1, 0.2, 0.3, -1.0, -1.0, 1.0, 1.5],
+            'baf': [0.6, np.nan, 0.7, np.nan, np.nan, 0.4, np.nan],
+            'weight': [1.0, 1.0, 1.0, 0.5, 0.5, 0.0, 0.0],
+        })
+        result = segfilters.squash_by_groups(cnarr,
+                                             np.array([0, 0, 0, 1, 1, 2, 2]))
+        self.assertEqual(len(result), 3)
+        # A NaN value makes the weighted mean NaN, as np.average does
+        self.assertTrue(np.isnan(result['baf'].iat[0]))
+        self.assertAlmostEqual(result['log2'].iat[0], 0.2)
+        self.assertTrue(np.isnan(result['baf'].iat[1]))
+        # Unweighted groups take the plain mean, skipping NaN
+        self.assertAlmostEqual(result['baf'].iat[2], 0.4)
+        self.assertAlmostEqual(result['log2'].iat[2], 1.25)
+
+    def test_squash_by_groups(self):
+        """Merge segments by level, chromosome and allele-specific CN."""
+        cnarr = cnary.CopyNumArray.from_columns({
+            'chromosome': ['chr1'] * 5 + ['chr2'] * 2,
+            'start': np.arange(7) * 100,
+            'end': np.arange(7) * 100 + 100,
+            'gene': ['A', 'A', 'B', 'B', 'C', 'D', 'D'],
+            'log2': [0.0, 0.3, 0.6, -1.0, 1.0, 2.0, 3.0],
+            'depth': [10., 20., 30., 5., 50., 60., 70.],
+            'baf': [0.5, 0.6, 0.7, np.nan, 0.8, np.nan, 0.9],
+            'probes': [10, 20, 10, 5, 8, 2, 2],
+            'weight': [1.0, 2.0, 1.0, 0.5, 1.0, 0.0, 0.0],
+            'cn': [2, 2, 2, 2, 3, 3, 3],
+            'cn1': [1, 1, 1, 0, 1, 1, 1],
+            'cn2': [1, 1, 1, 2, 2, 2, 2],
+            'p_bintest': [.01, .2, .05, .3, .4, .5, .6],
+        })
+        levels = np.array([0, 0, 0, 0, 1, 1, 1])
+        result = segfilters.squash_by_groups(cnarr, levels)
+        # Row 3 splits off by cn1; row 4 by chromosome
+        self.assertEqual(len(result), 4)
+        self.assertEqual(list(result.chromosome),
+                         ['chr1', 'chr1', 'chr1', 'chr2'])
+        self.assertEqual(list(result.start), [0, 300, 400, 500])
+        self.assertEqual(list(result.end), [300, 400, 500, 700])
+        self.assertEqual(list(result['gene']), ['A,B', 'B', 'C', 'D'])
+        self.assertEqual(list(result['probes']), [40, 5, 8, 4])
+        self.assertEqual(list(result['cn']), [2, 2, 3, 3])
+        self.assertEqual(list(result['cn1']), [1, 0, 1, 1])
+        self.assertEqual(list(result['cn2']), [1, 2, 2, 2])
+        np.testing.assert_allclose(result['weight'], [4.0, 0.5, 1.0, 0.0])
+        np.testing.assert_allclose(result['p_bintest'], [.2, .3, .4, .6])
+        # Weighted means, or plain means for the zero-weight group
+        np.testing.assert_allclose(result['log2'], [0.3, -1.0, 1.0, 2.5])
+        np.testing.assert_allclose(result['depth'], [20., 5., 50., 65.])
+        np.testing.assert_allclose(result['baf'], [0.6, np.nan, 0.8, 0.9])
+        # Nothing to merge
+        result = segfilters.squash_by_groups(cnarr, np.arange(7))
+        self.assertEqual(len(result), 7)
+        self.assertEqual(list(result['cn2']), [1, 1, 1, 2, 2, 2, 2])
+        np.testing.assert_allclose(result['baf'], cnarr['baf'])
+
+    def test_squash_nan_runs(self):
+        """Adjacent segments with missing allelic CN merge together."""
+        self.assertEqual(
+            list(segfilters.enumerate_changes(
+                np.array([np.nan, np.nan, 1, 1, np.nan, 2, np.nan, np.nan]))),
+            [0, 0, 1, 1, 2, 3, 4, 4])
+        cnarr = cnary.CopyNumArray.from_columns({
+            'chromosome': ['chr1'] * 6,
+            'start': np.arange(6) * 100,
+            'end': np.arange(6) * 100 + 100,
+            'gene': ['-'] * 6,
+            'log2': [0.0] * 6,
+            'weight': [1.0] * 6,
+            'cn': [2, 2, 2, 2, 3, 3],
+            'cn1': [np.nan] * 4 + [1, 1],
+            'cn2': [np.nan] * 4 + [2, 2],
+        })
+        result = segfilters.cn(cnarr)
+        self.assertEqual(list(result['cn']), [2, 3])
+        self.assertEqual(list(result['probes']), [4, 2])
+
+    def test_cn_subclone_nan(self):
+        """Adjacent segments with missing subclone fields merge together."""
+        nan = np.nan
+        cnarr = cnary.CopyNumArray.from_columns({
+            'chromosome': ['chr1'] * 6,
+            'start': np.arange(6) * 100,
+            'end': np.arange(6) * 100 + 100,
+            'gene': ['-'] * 6,
+            'log2': [0.0] * 6,
+            'weight': [1.0] * 6,
+            'cn': [2, 2, 2, 2, 2, 2],
+            'cn1': [nan, nan, 1, 1, nan, nan],
+            'cn2': [nan, nan, 1, 1, nan, nan],
+            'aberrant_cell_frac': [nan, nan, .5, .5, nan, nan],
+        })
+        result = segfilters.cn_subclone(cnarr)
+        self.assertEqual(list(result['probes']), [2, 2, 2])
+        self.assertEqual(list(result.start), [0, 200, 400])
+        self.assertEqual(list(result['cn1'].isnull()), [True, False, True])
+
     # call
     # Test: convert_clonal(x, 1, 2) == convert_diploid(x)
 
@@ -65,6 +65,13 @@ class GaryTests(unittest.TestCase):
                 row_count += len(rows)
             self.assertEqual(row_count, len(cnarr))
 
+    def test_arm_starts(self):
+        for fname in ("formats/amplicon.cnr", "formats/p2-20_1.cnr"):
+            cnarr = read(fname)
+            arm_lengths = [len(rows) for _chrom, rows in cnarr.by_arm()]
+            expect = np.cumsum([0] + arm_lengths[:-1])
+            self.assertEqual(cnarr.arm_starts().tolist(), expect.tolist())
+
     # def test_concat(self):
 
     def test_filter(self):